@@ -10,23 +10,45 @@ files, with support for both MSVC (Windows) and GCC (Linux/macOS).
 __version__ = "0.1.0"
 __all__ = ["CXXBuilder", "ModiGCC", "ModiMSVC"]
 
-import multiprocessing
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import subprocess
 from setuptools import setup, Extension, Distribution
 import os
 import sys
 import re
 import json
+import shlex
+import shutil
+import hashlib
 from pathlib import Path
 
+_MAX_CMDLINE = 32000
+_MANIFEST = 'build/.manifest.json'
+_CXX_EXTS = ('.cpp', '.cc', '.cxx', '.c++')
+_DEPCACHE = 'build/.depcache.json'
+_OBJ_STRIP = re.compile(r"^.*[\\/].[\\/]")
+# whitespace not escaped by a backslash, as in make rules
+_DEPS_SPLIT = re.compile(r'(?<!\\)\s+')
+
+
+def _join(argv):
+    """ command line text of argv for logs and compile_commands.json """
+    return subprocess.list2cmdline(argv) if os.name == 'nt' else shlex.join(argv)
+
 
 class ModiMSVC:
     def init(self, obj):
         _ = self
         obj.macros.extend([('_CRT_SECURE_NO_WARNINGS', 1), ('_CRT_NONSTDC_NO_DEPRECATE', 1), ('UNICODE', 1),
                            ('_UNICODE', 1), ('_DISABLE_CONSTEXPR_MUTEX_CONSTRUCTOR', 1)])
-        obj.extra_compile_args.extend([f'/Fdbuild/{obj.sysver}.pdb', '/FS', '/Zi', '/O2', '/MD', '/EHsc', '/utf-8', '/std:c++20'])
+        # /Z7 keeps debug info inside each .obj: no shared pdb, so objects are self-contained and cacheable
+        obj.extra_compile_args.extend(['/Z7', '/O2', '/MD', '/EHsc', '/utf-8', '/std:c++20'])
         obj.extra_link_args.extend(['/debug', '/nodefaultlib:LIBCMT', '/opt:ref', '/opt:icf'])
+        if os.environ.get('SOURCE_DATE_EPOCH'):
+            # cl rejects redefining __DATE__/__TIME__ (C4117), /Brepro drops the timestamps from objects and images
+            obj.extra_compile_args.append('/Brepro')
+            obj.extra_link_args.append('/Brepro')
         obj.libs2 = ['gdi32', 'user32', 'advapi32', 'ws2_32', 'ntdll']
         obj.obj_ext = '.obj'
         os.environ['VSLANG'] = '1033'
@@ -34,52 +56,120 @@ class ModiMSVC:
     def detect(self, blder, hdr, lib, macros):
         pass
 
-    def compile_cmd(self, blder, inputfn, output):
+    def compile_opts(self, blder):
+        """ include and define flags shared by every compile of a build """
         _ = self
-        if re.search(r'\.asm$', inputfn, re.I):
-            return f"""ml64 /nologo /c /Fo{output} {inputfn}"""
-        opts = []
-        for d in blder.include_dirs:
-            opts.append("/I\"%s\"" % d)
-        for m in blder.macros:
-            opts.append("/D%s=%s" % m)
-        return f"""cl /nologo /c {" ".join(opts)} /Fo{output} {inputfn} {" ".join(blder.extra_compile_args)}"""
+        return [*("/I%s" % d for d in blder.include_dirs), *("/D%s=%s" % m for m in blder.macros)]
+
+    def compile_argv(self, blder, inputfn, output):
+        _ = self
+        if inputfn.lower().endswith('.asm'):
+            return ['ml64', '/nologo', '/c', f'/Fo{output}', inputfn]
+        opts = blder.compile_opts()
+        if inputfn.lower().endswith(_CXX_EXTS):
+            opts = opts + blder._pch_flags
+        return ['cl', '/nologo', '/c', *opts, '/sourceDependencies', self.deps_file(inputfn, output),
+                f'/Fo{output}', inputfn, *blder.extra_compile_args]
+
+    def compile_batch_argv(self, blder, inputs, outdir, nprocess=1):
+        """ compile several sources in one cl process, objects go to outdir as <stem>.obj and the
+        dependency lists as <name>.json. with /MP cl spreads the sources over nprocess child compilers itself.
+        returns (argv, cwd) """
+        _ = self
+        if any(fn.lower().endswith('.asm') for fn in inputs):
+            return None
+        opts = ([f"/MP{nprocess}"] if nprocess > 1 else []) + blder.compile_opts()
+        if inputs[0].lower().endswith(_CXX_EXTS):
+            opts += blder._pch_flags
+        return ['cl', '/nologo', '/c', *opts, '/sourceDependencies', outdir, f'/Fo{outdir}\\', *inputs,
+                *blder.extra_compile_args], None
+
+    def batch_outputs(self, blder, inputfn, outdir, output):
+        """ [(written by the batch, final name), ...] for one source of a batched compile """
+        _ = self
+        name = os.path.basename(inputfn)
+        return [(os.path.join(outdir, os.path.splitext(name)[0] + blder.obj_ext), output),
+                (os.path.join(outdir, name + '.json'), output + '.json')]
+
+    def deps_file(self, inputfn, output):
+        """ json dependency list cl writes beside the object with /sourceDependencies, none for ml64 """
+        _ = self
+        if inputfn.lower().endswith('.asm'):
+            return None
+        return output + '.json'
 
-    def lib_cmd(self, blder, name, objs):
+    def pch_argv(self, blder, header):
+        """ precompile header through a stub source with /Yc. returns (stub, argv, pch file, stub object) """
+        _ = self
+        pdir = f"build/pch{blder.sysver}"
+        stub, output, obj = f"{pdir}/pch.cpp", f"{pdir}/pch.pch", f"{pdir}/pch{blder.obj_ext}"
+        argv = ['cl', '/nologo', '/c', *blder.compile_opts(), f'/Yc{header}', f'/Fp{output}', f'/Fo{obj}',
+                '/sourceDependencies', self.deps_file(stub, output), stub, *blder.extra_compile_args]
+        blder._pch_flags = [f'/Yu{header}', f'/FI{header}', f'/Fp{os.path.abspath(output)}']
+        return stub, argv, output, obj
+
+    def parse_deps(self, text):
+        _ = self
+        return json.loads(text)['Data']['Includes']
+
+    def lib_argv(self, blder, name, objs):
         _ = self, blder
         fname = f"build/{name}.lib"
-        return f"""lib /nologo /OUT:"{fname}" {" ".join(objs)}""", fname
+        return ['lib', '/nologo', f'/OUT:{fname}', *objs], fname
+
+    def lib_update_argv(self, _blder, fname, objs):
+        """ replace or add objs in the existing library """
+        _ = self
+        return ['lib', '/nologo', f'/OUT:{fname}', fname, *objs]
 
-    def test_cmd(self, _blder, _d, _s):
+    def test_argv(self, _blder, _d, _s):
         return None, None
 
     def link_args(self, blder, slib):
         _ = self
         arg1 = [f"/WHOLEARCHIVE:{slib}"]
-        libs = []
-        for lib in blder.libs + blder.libs2:
-            if isinstance(lib, tuple):
-                libs.append(lib[0])
-            else:
-                libs.append(lib)
+        libs = list(_unique_libs(blder.libs + blder.libs2))
         arg1 += blder.extra_link_args
         return libs, arg1
 
 
+def _unique_libs(libs):
+    """ {name: prefer_static} for a list of names and (name, prefer_static) tuples.
+    each library appears once, at its first position, static if any entry asked for it """
+    ret = dict()
+    for lib in libs:
+        name, static = (lib[0], bool(lib[1])) if isinstance(lib, tuple) else (lib, False)
+        ret[name] = ret.get(name, False) or static
+    return ret
+
+
+@functools.lru_cache(maxsize=None)
+def _gcc_libdirs(gcc, mtime):
+    """ multiarch lib dirs of gcc's target triplet, cached per compiler binary and its mtime """
+    _ = mtime
+    libdirs = []
+    gcc_machine = subprocess.check_output([gcc, '-dumpmachine'], universal_newlines=True).strip()
+    m1 = gcc_machine.replace("-pc-", "-")
+    for p in {gcc_machine, m1}:
+        if os.path.isdir(f'/usr/lib/{p}'):
+            libdirs.append(f'/usr/lib/{p}')
+    return tuple(libdirs)
+
+
 class ModiGCC:
     def __init__(self):
-        self.libdir1 = []
-        gcc_machine = subprocess.check_output(['gcc', '-dumpmachine'], universal_newlines=True).strip()
-        m1 = re.sub("-pc-", "-", gcc_machine)
-        for p in {gcc_machine, m1}:
-            if os.path.isdir(f'/usr/lib/{p}'):
-                self.libdir1.append(f'/usr/lib/{p}')
+        gcc = shutil.which('gcc') or 'gcc'
+        try:
+            mtime = os.stat(gcc).st_mtime_ns
+        except OSError:
+            mtime = None
+        self.libdir1 = list(_gcc_libdirs(gcc, mtime))
 
     def init(self, obj):
         _ = self
         obj.macros = []
-        obj.extra_compile_args = re.split(r'\s+', """-g -O2 -fpic -Wno-unknown-pragmas -Wno-unused-result
-        -Wno-sign-compare -std=c++20 -ffunction-sections -fdata-sections""")
+        obj.extra_compile_args = """-g -O2 -fpic -Wno-unknown-pragmas -Wno-unused-result
+        -Wno-sign-compare -std=c++20 -ffunction-sections -fdata-sections""".split()
         osname = os.uname().sysname
         if osname == "Darwin":
             obj.extra_link_args.extend(['-lc++', '-g', '-Wl,-dead_strip', '-framework', 'Security'])
@@ -109,78 +199,129 @@ class ModiGCC:
                 return fn
         return "-l" + libname
 
-    def quote(self, s):
-        _ = self
-        return json.dumps(s)
+    @staticmethod
+    def compiler():
+        if sys.platform == "darwin":
+            return ['clang', '-arch', 'x86_64', '-arch', 'arm64', '-mmacos-version-min=10.15']
+        return ['gcc']
 
-    def compile_cmd(self, blder, inputfn, output):
+    def compile_opts(self, blder):
+        """ include, define and extra flags shared by every compile of a build """
         _ = self
+        return [*("-I%s" % d for d in blder.include_dirs), *("-D%s=%s" % m for m in blder.macros),
+                *blder.extra_compile_args]
+
+    def compile_argv(self, blder, inputfn, output):
+        opts = blder.compile_opts()
+        if inputfn.lower().endswith(_CXX_EXTS):
+            opts = opts + blder._pch_flags
+        return [*self.compiler(), '-c', *opts, '-MMD', '-MF', self.deps_file(inputfn, output),
+                '-o', output, inputfn]
+
+    def compile_batch_argv(self, blder, inputs, outdir, nprocess=1):
+        """ compile several sources in one driver process. returns (argv, cwd)
+        gcc refuses -o with multiple inputs, so run inside outdir and let it write <stem>.o and <stem>.d there.
+        include dirs are made absolute for that; other relative paths in flags or macro values are not """
+        _ = nprocess
         opts = []
         for d in blder.include_dirs:
-            opts.append("-I%s" % d)
+            opts.append("-I%s" % os.path.abspath(d))
         for m in blder.macros:
-            opts.append("-D%s=%s" % (m[0], self.quote(m[1])))
+            opts.append("-D%s=%s" % m)
         opts += blder.extra_compile_args
-        compiler = "gcc"
+        if inputs[0].lower().endswith(_CXX_EXTS):
+            opts += blder._pch_flags
+        return [*self.compiler(), '-c', *opts, '-MMD', *inputs], outdir
+
+    def batch_outputs(self, blder, inputfn, outdir, output):
+        """ [(written by the batch, final name), ...] for one source of a batched compile """
+        _ = self
+        stem = os.path.join(outdir, os.path.splitext(os.path.basename(inputfn))[0])
+        return [(stem + blder.obj_ext, output), (stem + '.d', output + '.d')]
+
+    def deps_file(self, inputfn, output):
+        """ make rule listing the user headers, written by the compile itself with -MMD """
+        _ = self, inputfn
+        return output + '.d'
+
+    def pch_argv(self, blder, header):
+        """ precompile header as <stub>.gch next to a stub including it, so -include stub falls back
+        to the plain header when the pch is unusable. returns (stub, argv, pch file, None) """
+        _ = header
         if sys.platform == "darwin":
-            compiler = "clang -arch x86_64 -arch arm64 -mmacos-version-min=10.15"
-        return f"{compiler} -c {' '.join(opts)} -o {output} {inputfn}"
+            # a driver with several -arch cannot write one pch
+            return None
+        stub = f"build/pch{blder.sysver}/pch.hxx"
+        output = stub + ".gch"
+        blder._pch_flags = ['-include', os.path.abspath(stub), '-Winvalid-pch']
+        argv = [*self.compiler(), '-x', 'c++-header', *blder.compile_opts(),
+                '-MMD', '-MF', self.deps_file(stub, output), '-o', output, stub]
+        return stub, argv, output, None
+
+    def parse_deps(self, text):
+        _ = self
+        rule = text.replace('\\\n', ' ')
+        rule = rule[rule.find(': ') + 2:]
+        return [x.replace('\\ ', ' ') for x in _DEPS_SPLIT.split(rule.strip())]
 
-    def lib_cmd(self, blder, name, objs):
+    def lib_argv(self, blder, name, objs):
         _ = self, blder
         fname = f"build/lib{name}.a"
-        prefix = "libtool -static -o" if sys.platform == "darwin" else "ar rcs"
-        return f"""{prefix} "{fname}" {" ".join(sorted(objs))}""", fname
+        prefix = ['libtool', '-static', '-o'] if sys.platform == "darwin" else ['ar', 'rcs']
+        return [*prefix, fname, *sorted(objs)], fname
 
-    def test_cmd(self, blder, dest, libfn):
+    def lib_update_argv(self, _blder, fname, objs):
+        """ replace or add objs in the existing archive. libtool has no update mode """
+        _ = self
+        if sys.platform == "darwin":
+            return None
+        return ['ar', 'rcs', fname, *sorted(objs)]
+
+    def test_argv(self, blder, dest, libfn):
         if not blder._need_test_link:
             return None, None
         import sysconfig
         libpython = sysconfig.get_config_var('LDLIBRARY')
         libdir = sysconfig.get_config_var('LIBDIR')
-        cmd = []
-        for d in blder.include_dirs:
-            cmd.append("-I%s" % d)
-        for m in blder.macros:
-            cmd.append("-D%s=%s" % (m[0], self.quote(m[1])))
-        cmd += blder.extra_compile_args
-        cmd += [f"-DTEST_LINKER=1", blder.mainsrc, f"-L{libdir}"]
+        cmd = blder.compile_opts() + [f"-DTEST_LINKER=1", blder.mainsrc, f"-L{libdir}"]
         if sys.platform == 'darwin':
-            cmd.extend(["-F"+sysconfig.get_config_var("PYTHONFRAMEWORKPREFIX"), f"-framework Python", sysconfig.get_config_var('LIBS')])
+            cmd.extend(["-F"+sysconfig.get_config_var("PYTHONFRAMEWORKPREFIX"), "-framework", "Python"])
+            cmd.extend(shlex.split(sysconfig.get_config_var('LIBS')))
         else:
             cmd.append(f"-l:{libpython}")
         cmd += [f"-L{x}" for x in blder.libdirs]
         cmd += self.link_args(blder, libfn)[1]
         info = {"cmd": cmd, "dest": dest}
         blder.on_hook('test_link_args', info)
-        cmd = f"""gcc -o {info['dest']} {" ".join(info['cmd'])}"""
-        return cmd, info['dest']
+        return ['gcc', '-o', info['dest'], *info['cmd']], info['dest']
 
     def link_args(self, blder, slib):
         if sys.platform == 'darwin':
             arg1 = [f'-Wl,-force_load,{slib}']
         else:
             arg1 = [f"-Wl,--whole-archive", slib, f"-Wl,--no-whole-archive"]
-        for lib in blder.libs+blder.libs2:
-            if isinstance(lib, tuple):
-                if lib[1]:
-                    arg1.append(self.pref_static(lib[0]))
-                    continue
-                lib = lib[0]
-            arg1.append("-l" + lib)
+        for lib, static in _unique_libs(blder.libs + blder.libs2).items():
+            arg1.append(self.pref_static(lib) if static else "-l" + lib)
         arg1 += blder.extra_link_args
         return [], arg1
 
 
 class CXXBuilder:
     @staticmethod
-    def verbose_build(cmd):
-        print(cmd)
+    def verbose_build(argv, **kwargs):
+        print(_join(argv))
         sys.stdout.flush()
-        return os.system(cmd)
+        return subprocess.call(argv, **kwargs)
 
     @staticmethod
     def load_toml(path) -> dict:
+        """ parsed toml file, cached per path and mtime. the returned dict is shared, do not modify it """
+        return CXXBuilder._load_toml_cached(os.path.abspath(path), os.stat(path).st_mtime_ns)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _load_toml_cached(path, mtime) -> dict:
+        _ = mtime
         path = Path(path)
         try:
             # Python 3.11+
@@ -202,10 +343,21 @@ class CXXBuilder:
         self.extra_link_args = []
         self.files = dict()
         self.mainsrc = None
+        self.pch = None
+        self._pch_flags = []
+        self._pch_key = None
         self._need_test_link = False
         self.sysver = f"{sys.version_info[0]}.{sys.version_info[1]}"
         self.obj_ext = '.o'
-        self.bld_func = os.system
+        self.bld_func = subprocess.call
+        self._stats = dict()
+        self._opts = None
+        # ccache/sccache cannot cache a compile with several inputs, so batching is off when one is used
+        self.cc_wrapper = shutil.which('sccache' if self.is_win else 'ccache')
+        if self.cc_wrapper:
+            os.environ.setdefault('CCACHE_BASEDIR', os.getcwd())
+            os.environ.setdefault('CCACHE_COMPILERCHECK', 'content')
+        self.batch_compile = self.is_win and not self.cc_wrapper
         proj_desc = self.load_toml('pyproject.toml')
         self.name = proj_desc['project']['name']
         self.version = proj_desc['project'].get('version', '0.1.0')
@@ -233,7 +385,7 @@ class CXXBuilder:
         for fn in files:
             if not fn:
                 continue
-            objn = f"build/objs{self.sysver}/" + re.sub(r"^.*[\\/].[\\/]", "", fn) + self.obj_ext
+            objn = f"build/objs{self.sysver}/" + _OBJ_STRIP.sub("", fn) + self.obj_ext
             objn = os.path.normpath(objn)
             fullfn = fn if directory is None else os.path.join(directory, fn)
             fullfn = os.path.abspath(fullfn)
@@ -257,78 +409,382 @@ class CXXBuilder:
         if fullfn in self.files:
             del self.files[fullfn]
 
-    def compile_cmd(self, inputfn, output, kind=None):
+    def set_pch(self, header, directory=None):
+        """ precompile header and force-include it into every C++ source """
+        fullfn = header if directory is None else directory + "/" + header
+        self.pch = os.path.abspath(fullfn)
+
+    def compile_opts(self):
+        """ flags shared by every compile. fixed while build() runs, outside of it they follow
+        the current include dirs, macros and extra compile args """
+        if self._opts is None:
+            return self.modi.compile_opts(self)
+        return self._opts
+
+    def compile_argv(self, inputfn, output, kind=None):
         if kind == 'embed':
-            return f"""{sys.executable} -m py_cxx_builder embed {inputfn} {output}"""
-        return self.modi.compile_cmd(self, inputfn, output)
+            return [sys.executable, '-m', 'py_cxx_builder', 'embed', inputfn, output]
+        return self.modi.compile_argv(self, inputfn, output)
 
     def build(self, nprocess=None):
         major_version, minor_version, patch_version = tuple([int(x) for x in self.version.split('.')])
         self.add_macro('PROJ_MAJOR_VERSION', major_version)
         self.add_macro('PROJ_MINOR_VERSION', minor_version)
         self.add_macro('PROJ_PATCH_VERSION', patch_version)
+        # one definition per name, the last value wins
+        self.macros = list(dict(self.macros).items())
         assert self.mainsrc is not None
         self.include_dirs = self._get_include_dirs()
         self.libdirs = self._get_lib_dirs()
+        # the shared flags are built once for all commands of this build, and dropped again afterwards
+        self._opts = self.modi.compile_opts(self)
+        try:
+            self._build(nprocess)
+        finally:
+            self._opts = None
+
+    def _build(self, nprocess):
         dirs = dict()
         for _, v in self.files.items():
-            dirs[re.sub(r"[\\/][^\\/]+$", '', v[0])] = True
+            dirs[os.path.dirname(v[0])] = True
         for d in sorted(dirs.keys()):
-            if not os.path.isdir(d):
-                os.makedirs(d, exist_ok=True)
+            os.makedirs(d, exist_ok=True)
+        self._manifest = self._load_json(_MANIFEST)
+        self._depcache = self._load_json(_DEPCACHE)
+        self._hashes = dict()
+        self._stats = self._scan_stats(self.files.keys())
         o_cmds = []
-        cmds = []
+        pending = []
         objs = []
+        if self.pch:
+            objs += self._build_pch()
         for k, v in self.files.items():
             kind = v[1]
-            cmd = self.compile_cmd(k, v[0], kind)
-            o_cmds.append({"directory": os.getcwd(), "command": cmd, "file": k, "output": v[0]})
+            argv = self.compile_argv(k, v[0], kind)
+            o_cmds.append({"directory": os.getcwd(), "command": _join(argv), "file": k, "output": v[0]})
             objs.append(v[0])
-            if self._need_compile(k, v[0], kind):
-                cmds.append(cmd)
-        libcmd, libfn = self.modi.lib_cmd(self, f'objs-static{self.sysver}', objs)
-        testcmd, testfn = self.modi.test_cmd(self, 'test_compile.exe', libfn)
+            if self._need_compile(k, v[0], kind, self._cmd_key(k, argv)):
+                pending.append((k, v[0], kind, argv))
+        libargv, libfn = self.modi.lib_argv(self, f'objs-static{self.sysver}', objs)
+        testargv, testfn = self.modi.test_argv(self, 'test_compile.exe', libfn)
         if nprocess is None:
             nprocess = os.cpu_count()
-        nprocess = min(len(cmds), nprocess)
+        if not self.batch_compile:
+            jobs = [(self._launch_argv(p), None, [], [p]) for p in pending]
+            nprocess = min(len(jobs), nprocess)
+        elif self.is_win:
+            # cl /MP fans out by itself, so run the batches one after another
+            jobs = self._batch_jobs(pending, 1, nprocess)
+            nprocess = min(len(jobs), 1)
+        else:
+            jobs = self._batch_jobs(pending, 2 * nprocess)
+            nprocess = min(len(jobs), nprocess)
+        done = []
+        failed = False
+        pool = None
         if nprocess > 1:
-            with multiprocessing.Pool(processes=nprocess) as pool:
-                ress = [pool.apply_async(self.bld_func, (cmd,)) for cmd in cmds]
-                codes = [res.get() for res in ress]
-                if any(c != 0 for c in codes):
-                    raise Exception("compile error")
-        elif nprocess == 1:
-            for cmd in cmds:
-                print(cmd, file=sys.stderr, flush=True)
-                if os.system(cmd) != 0:
-                    raise Exception("compile error")
-        if nprocess > 0 or not os.path.isfile(libfn):
-            with open('compile_commands.json', 'w') as f:
-                json.dump(o_cmds, f, indent=4, ensure_ascii=False)
-            print(libcmd, file=sys.stderr, flush=True)
-            if os.system(libcmd) != 0:
+            # workers only wait on child compilers, so threads are enough
+            pool = ThreadPoolExecutor(max_workers=nprocess)
+        try:
+            if nprocess > 1:
+                futures = {pool.submit(self.bld_func, job[0], **({'cwd': job[1]} if job[1] else {})): job
+                           for job in jobs}
+                for fut in as_completed(futures):
+                    if fut.cancelled():
+                        continue
+                    if fut.result() != 0:
+                        if not failed:
+                            # fail fast: drop the queued compiles, the running ones still finish
+                            failed = True
+                            for f in futures:
+                                f.cancel()
+                        continue
+                    done += self._finish_job(futures[fut])
+            elif nprocess == 1:
+                for job in jobs:
+                    print(_join(job[0]), file=sys.stderr, flush=True)
+                    if subprocess.call(job[0], cwd=job[1]) != 0:
+                        failed = True
+                        break
+                    done += self._finish_job(job)
+            self._record(done)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+            self._save_json(_MANIFEST, self._manifest)
+            self._save_json(_DEPCACHE, self._depcache)
+        if failed:
+            raise Exception("compile error")
+        libargv, members = self._archive_argv(libargv, libfn, objs)
+        if libargv:
+            self._write_compile_commands(o_cmds)
+            print(_join(libargv), file=sys.stderr, flush=True)
+            if subprocess.call(libargv) != 0:
+                self._manifest.pop(libfn, None)
+                self._save_json(_MANIFEST, self._manifest)
                 raise Exception("link error")
+            self._manifest[libfn] = {"objs": members}
+            self._save_json(_MANIFEST, self._manifest)
             os.utime(self.mainsrc, None)
         if testfn and self._need_compile(libfn, testfn):
-            print(testcmd, file=sys.stderr, flush=True)
-            if os.system(testcmd) != 0:
+            print(_join(testargv), file=sys.stderr, flush=True)
+            if subprocess.call(testargv) != 0:
                 raise Exception('link error')
 
         setup(name=self.name, version=self.version, ext_modules=[self._ext_module(self.name, libfn)])
 
-    def _need_compile(self, src, dst, kind=None):
-        _ = self
+    def _build_pch(self):
+        """ (re)compile the precompiled header before the sources using it. returns extra objects to archive """
+        self._pch_flags = []
+        self._pch_key = None
+        ret = self.modi.pch_argv(self, self.pch)
+        if ret is None:
+            return []
+        stub, argv, output, obj = ret
+        # spelled exactly as in /Yc, /Yu and /FI: cl matches the #include against that name
+        text = f'#include "{self.pch}"\n'
+        os.makedirs(os.path.dirname(stub), exist_ok=True)
+        if not os.path.isfile(stub) or Path(stub).read_text() != text:
+            Path(stub).write_text(text)
+        if self._need_compile(stub, output, 'pch', self._cmd_key(stub, argv)):
+            print(_join(argv), file=sys.stderr, flush=True)
+            if subprocess.call(argv) != 0:
+                raise Exception("compile error")
+            self._record([(stub, output, 'pch', argv)])
+        # sources built on the pch are out of date whenever the pch content is
+        self._pch_key = json.dumps(self._manifest.get(output), sort_keys=True)
+        return [obj] if obj else []
+
+    def _archive_argv(self, libargv, libfn, objs):
+        """ command bringing the archive up to date and the member stats to record once it succeeds.
+        only objects whose stat changed since the last archive run are added to an existing archive;
+        the first build, removed objects and clashing member names start a fresh one """
+        members = dict()
+        for o in objs:
+            st = os.stat(o)
+            members[o] = [st.st_mtime_ns, st.st_size]
+        old = self._manifest.get(libfn, {}).get("objs")
+        if old is not None and os.path.isfile(libfn) and old.keys() <= members.keys():
+            changed = [o for o in objs if old.get(o) != members[o]]
+            if not changed:
+                return None, members
+        else:
+            changed = None
+        if changed and len({os.path.basename(o) for o in objs}) == len(objs):
+            argv = self.modi.lib_update_argv(self, libfn, changed)
+            if argv:
+                return argv, members
+        if os.path.isfile(libfn):
+            os.remove(libfn)
+        return libargv, members
+
+    def _cmd_key(self, src, argv):
+        """ text identifying how src is compiled, for the manifest """
+        cmd = _join(argv)
+        if self._pch_key and src.lower().endswith(_CXX_EXTS):
+            cmd += "\n" + self._pch_key
+        return cmd
+
+    def _batch_jobs(self, pending, nchunk, nprocess=1):
+        """ group sources sharing kind, output dir and suffix, and split each group into nchunk chunks
+        that are compiled by a single compiler invocation. every batch writes its <stem> objects into a
+        directory of its own, so batches running side by side never share a file.
+        returns [(argv, cwd, [(produced, obj), ...], items), ...] """
+        groups = dict()
+        for item in pending:
+            src, obj, kind, _ = item
+            key = (kind, os.path.dirname(obj), os.path.splitext(src)[1].lower())
+            groups.setdefault(key, []).append(item)
+        jobs = []
+        for (kind, outdir, _), items in groups.items():
+            size = -(-len(items) // max(1, nchunk))
+            chunks = [items[i:i + size] for i in range(0, len(items), size)]
+            while chunks:
+                chunk = chunks.pop(0)
+                if kind == 'embed' or len(chunk) < 2:
+                    jobs.extend((self._launch_argv(x), None, [], [x]) for x in chunk)
+                    continue
+                # one batch writes each stem once, a repeated stem moves on to a later batch
+                stems, first, later = set(), [], []
+                for x in chunk:
+                    stem = os.path.splitext(os.path.basename(x[0]))[0].lower()
+                    (later if stem in stems else first).append(x)
+                    stems.add(stem)
+                if later:
+                    chunk = first
+                    chunks.append(later)
+                tmpdir = os.path.join(outdir, f".batch{len(jobs)}")
+                batch = self.modi.compile_batch_argv(self, [x[0] for x in chunk], tmpdir, nprocess)
+                if batch is not None and len(_join(batch[0])) > _MAX_CMDLINE:
+                    # keep below the CreateProcess command line limit
+                    half = len(chunk) // 2
+                    chunks += [chunk[:half], chunk[half:]]
+                    continue
+                if batch is None:
+                    jobs.extend((self._launch_argv(x), None, [], [x]) for x in chunk)
+                    continue
+                os.makedirs(tmpdir, exist_ok=True)
+                renames = [r for x in chunk for r in self.modi.batch_outputs(self, x[0], tmpdir, x[1])]
+                jobs.append((*batch, renames, chunk))
+        return jobs
+
+    def _launch_argv(self, item):
+        """ command run for a single compile. the compiler cache only goes in front here, so that it stays
+        out of compile_commands.json and the manifest and adding or moving it rebuilds nothing """
+        src, _, kind, argv = item
+        if not self.cc_wrapper or kind == 'embed' or src.lower().endswith('.asm'):
+            return argv
+        return [self.cc_wrapper, *argv]
+
+    @staticmethod
+    def _finish_job(job):
+        """ move objects written by a batched compile to their per-source names, return the compiled items """
+        for produced, obj in job[2]:
+            os.replace(produced, obj)
+        if job[2]:
+            try:
+                os.rmdir(os.path.dirname(job[2][0][0]))
+            except OSError:
+                pass
+        return job[3]
+
+    def _record(self, items):
+        """ store manifest entries for freshly compiled items """
+        deps = self._scan_deps(items)
+        for src, obj, kind, argv in items:
+            if deps[src] is None:
+                self._manifest.pop(obj, None)
+                continue
+            self._manifest[obj] = {"src": self._file_hash(src), "cmd": self._str_hash(self._cmd_key(src, argv)),
+                                   "deps": {h: self._file_hash(h) for h in deps[src]}}
+
+    def _scan_deps(self, items):
+        """ the headers each source included, read from the dependency file its compile wrote.
+        returns {src: [header, ...]}, None for a source whose file is missing or unreadable """
+        ret = dict()
+        for src, obj, kind, _ in items:
+            fn = None if kind == 'embed' else self.modi.deps_file(src, obj)
+            if fn is None:
+                ret[src] = []
+                continue
+            try:
+                deps = [os.path.abspath(x) for x in self.modi.parse_deps(Path(fn).read_text(encoding='utf-8')) if x]
+            except (OSError, ValueError, KeyError):
+                ret[src] = None
+                continue
+            ret[src] = [x for x in dict.fromkeys(deps) if x != os.path.abspath(src)]
+        return ret
+
+    def _file_hash(self, path):
+        """ content hash of path. memoized for the current build, and across builds in the depcache
+        as long as size and mtime are unchanged """
+        if path in self._hashes:
+            return self._hashes[path]
+        st = self._stat(path)
+        if st is None:
+            self._hashes[path] = None
+            return None
+        key = [st.st_mtime_ns, st.st_size]
+        cached = self._depcache.get(path)
+        if cached and cached[:2] == key:
+            self._hashes[path] = cached[2]
+            return cached[2]
+        h = hashlib.blake2b(digest_size=16)
         try:
-            dstt = os.stat(dst)
-        except FileNotFoundError:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+        except OSError:
+            self._hashes[path] = None
+            return None
+        self._hashes[path] = h.hexdigest()
+        self._depcache[path] = key + [self._hashes[path]]
+        return self._hashes[path]
+
+    @staticmethod
+    def _scan_stats(paths, listing=os.name == 'nt'):
+        """ stat paths one directory listing at a time. only worth it on windows, which fills DirEntry.stat()
+        from the listing itself; elsewhere each entry costs a stat anyway, so nothing is scanned and
+        _stat falls back to os.stat """
+        if not listing:
+            return dict()
+        bydir = dict()
+        for p in paths:
+            d, name = os.path.split(p)
+            bydir.setdefault(d, dict())[name] = p
+        stats = dict()
+        for d, names in bydir.items():
+            try:
+                with os.scandir(d or '.') as it:
+                    for e in it:
+                        if e.name in names:
+                            stats[names[e.name]] = e.stat()
+            except OSError:
+                pass
+        return stats
+
+    def _stat(self, path):
+        """ stat of path from the per-build scan, or None if it doesn't exist """
+        st = self._stats.get(path)
+        if st is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+        return st
+
+    @staticmethod
+    def _str_hash(s):
+        return hashlib.blake2b(s.encode("utf-8"), digest_size=16).hexdigest()
+
+    @staticmethod
+    def _load_json(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    @staticmethod
+    def _write_compile_commands(o_cmds, path='compile_commands.json'):
+        """ leave the file (and its mtime) alone when nothing changed, so IDEs don't reindex """
+        try:
+            import orjson
+            data = orjson.dumps(o_cmds, option=orjson.OPT_INDENT_2)
+        except ImportError:
+            data = json.dumps(o_cmds, indent=2, ensure_ascii=False).encode('utf-8')
+        try:
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    return False
+        except OSError:
+            pass
+        with open(path, 'wb') as f:
+            f.write(data)
+        return True
+
+    @staticmethod
+    def _save_json(path, obj):
+        """ write atomically so an interrupted build never leaves a truncated file """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(obj, f, indent=1)
+        os.replace(tmp, path)
+
+    def _need_compile(self, src, dst, kind=None, cmd=None):
+        """ without cmd only compare mtimes, otherwise dst is up to date iff the manifest entry
+        recorded for it matches the current source, command line and header contents """
+        if not os.path.exists(dst):
             return True
-        srct = os.stat(src)
-        if dstt.st_mtime < srct.st_mtime:
+        if cmd is None:
+            return os.stat(dst).st_mtime_ns < os.stat(src).st_mtime_ns
+        entry = self._manifest.get(dst)
+        if not entry or entry['cmd'] != self._str_hash(cmd) or entry['src'] != self._file_hash(src):
             return True
-        if kind and kind == 'embed':
+        if kind == 'embed':
             return False
-        srct2 = os.stat(os.path.dirname(src) or '.')
-        return dstt.st_mtime < srct2.st_mtime
+        return any(self._file_hash(h) != v for h, v in entry['deps'].items())
 
     def _ext_module(self, name, slib):
         libs, linkargs = self.modi.link_args(self, slib)
@@ -341,15 +797,38 @@ class CXXBuilder:
                         extra_link_args=linkargs)
         return ext
 
-    def _get_include_dirs(self):
-        """ a hacker way to get the current python include dirs """
+    @staticmethod
+    def _python_include_dirs():
+        """ a hacker way to get the current python include dirs.
+        the answer only depends on the interpreter, so it is cached per executable and its mtime """
+        key = f"{sys.executable}|{sys.version}"
+        cache_dir = os.environ.get('LOCALAPPDATA' if os.name == 'nt' else 'XDG_CACHE_HOME') or \
+            os.path.join(os.path.expanduser('~'), '.cache')
+        cache_fn = os.path.join(cache_dir, 'py_cxx_builder',
+                                f"includes-{hashlib.blake2b(key.encode('utf-8'), digest_size=8).hexdigest()}.json")
+        try:
+            mtime = os.stat(sys.executable).st_mtime_ns
+        except OSError:
+            mtime = None
+        cached = CXXBuilder._load_json(cache_fn)
+        if mtime is not None and cached.get('key') == key and cached.get('mtime') == mtime:
+            return cached['include_dirs']
         dist = Distribution(dict(name='dummy', version='1.0', description='dummy', ext_modules=[
             Extension('dummy', sources=['dummy.c'])
         ]))
         co = dist.get_command_obj('build_ext')
         co.ensure_finalized()
+        include_dirs = list(getattr(co, 'include_dirs', []))
+        if mtime is not None:
+            try:
+                CXXBuilder._save_json(cache_fn, {'key': key, 'mtime': mtime, 'include_dirs': include_dirs})
+            except OSError:
+                pass
+        return include_dirs
+
+    def _get_include_dirs(self):
         seen = {''}
-        seq = getattr(co, 'include_dirs', []) + self.include_dirs
+        seq = self._python_include_dirs() + self.include_dirs
         return [x for x in seq if not (x in seen or seen.add(x))]
 
     def _get_lib_dirs(self):
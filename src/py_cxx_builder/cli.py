@@ -1,14 +1,17 @@
 import sys
 import os
-import re
+import binascii
+import shutil
+import struct
 import subprocess
 
 
 class Embedder:
-    def __init__(self, input_filename, output_obj):
+    def __init__(self, input_filename, output_obj, legacy=False):
         self.input_filename = input_filename
+        self.legacy = legacy
         basename = os.path.basename(input_filename)
-        self.var_name = re.sub(r'[.-]', '_', basename)
+        self.var_name = basename.replace('.', '_').replace('-', '_')
         if os.path.isdir(output_obj):
             self.c_filename = os.path.join(output_obj, f"{basename}.c")
             self.output_obj = os.path.join(output_obj, basename + (".obj" if os.name == 'nt' else '.o'))
@@ -16,20 +19,45 @@ class Embedder:
             output_dir = os.path.dirname(output_obj) or '.'
             self.c_filename = os.path.join(output_dir, f"{basename}.c")
             self.output_obj = output_obj
+        self.bin_filename = os.path.splitext(self.c_filename)[0] + ".payload"
 
-    def embed_file(self):
-        with open(self.input_filename, 'rb') as f:
-            content = f.read()
+    @staticmethod
+    def can_link_binary():
+        """ GNU ld can wrap a raw file into an object, ld64 and link.exe cannot """
+        return sys.platform.startswith('linux') and shutil.which('ld') and shutil.which('objcopy')
+
+    def link_binary(self):
+        """ turn the file into a .rodata object without going through the compiler.
+        the layout matches the C array: content, a NUL, then the size as an aligned unsigned int """
+        size = os.path.getsize(self.input_filename)
+        offset = (size + 1 + 3) & ~3
+        shutil.copyfile(self.input_filename, self.bin_filename)
+        with open(self.bin_filename, 'ab') as f:
+            f.write(bytes(offset - size) + struct.pack('=I', size))
+        subprocess.run(['ld', '-r', '-b', 'binary', '-z', 'noexecstack', '-o', self.output_obj, self.bin_filename],
+                       check=True)
+        subprocess.run(['objcopy', '--rename-section', '.data=.rodata,alloc,load,readonly,data,contents',
+                        '--set-section-alignment', '.data=16',
+                        '--add-symbol', f'{self.var_name}_content=.rodata:0,global,object',
+                        '--add-symbol', f'{self.var_name}_size=.rodata:{offset},global,object',
+                        '--wildcard', '--strip-symbol=_binary_*', self.output_obj], check=True)
 
-        c_array = ', '.join(f'0x{byte:02x}' for byte in content)
-        c_code = f"unsigned char const {self.var_name}_content[] = {{\n {c_array}\n,0\n}};\n"
-        c_code += f"unsigned int const {self.var_name}_size = sizeof({self.var_name}_content)-1;"
-        return c_code
+    def c_code_chunks(self, chunk_size=1 << 16):
+        """ the C source as a stream of pieces, reading the input a chunk at a time.
+        every element is followed by a comma so that an empty file is still a valid array """
+        yield b"#include <stddef.h>\n"  # 为了使用 sizeof
+        yield f"unsigned char const {self.var_name}_content[] = {{\n ".encode()
+        with open(self.input_filename, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                # hexlify with a separator stays in C: b'41 42' -> b'0x41, 0x42, '
+                yield b'0x' + binascii.hexlify(chunk, b' ').replace(b' ', b', 0x') + b', '
+        yield b"\n0\n};\n"
+        yield f"unsigned int const {self.var_name}_size = sizeof({self.var_name}_content)-1;".encode()
 
-    def write_c_file(self, c_code):
-        with open(self.c_filename, 'w') as f:
-            f.write("#include <stddef.h>\n")  # 为了使用 sizeof
-            f.write(c_code)
+    def write_c_file(self):
+        with open(self.c_filename, 'wb', buffering=1 << 20) as f:
+            for piece in self.c_code_chunks():
+                f.write(piece)
 
     def compile_c_file(self):
         if os.name == 'nt':
@@ -44,31 +72,42 @@ class Embedder:
             sys.exit(1)  # 以代码1退出
 
     def clean_up(self):
-        if os.path.exists(self.c_filename):
-            os.remove(self.c_filename)
+        for fn in (self.c_filename, self.bin_filename):
+            if os.path.exists(fn):
+                os.remove(fn)
 
     def run(self):
-        c_code = self.embed_file()
-        self.write_c_file(c_code)
+        if not self.legacy and self.can_link_binary():
+            try:
+                self.link_binary()
+                self.clean_up()
+                return
+            except subprocess.CalledProcessError as e:
+                print(f"Binary embedding failed ({e}), falling back to C source", file=sys.stderr)
+        self.write_c_file()
         self.compile_c_file()
         self.clean_up()
 
 
 def main():
     def usage():
-        print("Usage: python -m py_cxx_builder embed filename.ext out.obj")
+        print("Usage: python -m py_cxx_builder embed [--legacy] filename.ext out.obj")
 
-    if len(sys.argv) != 4:
+    args = sys.argv[1:]
+    legacy = '--legacy' in args
+    if legacy:
+        args.remove('--legacy')
+    if len(args) != 3:
         usage()
         sys.exit(1)
 
-    match sys.argv[1]:
+    match args[0]:
         case "embed":
-            input_filename, output_obj = sys.argv[2], sys.argv[3]
+            input_filename, output_obj = args[1], args[2]
             if not os.path.isfile(input_filename):
                 print(f"Error: {input_filename} is not a valid file.")
                 sys.exit(1)
-            embedder = Embedder(input_filename, output_obj)
+            embedder = Embedder(input_filename, output_obj, legacy)
             embedder.run()
 
         case _:
@@ -2,7 +2,23 @@
 
 import sys
 from pathlib import Path
+from types import SimpleNamespace
+import pytest
 
 # Add src directory to path for testing
 src_path = Path(__file__).parent.parent / "src"
 sys.path.insert(0, str(src_path))
+
+_CPP_EMPTY_MAIN = b'int main() { return 0; }'
+_CPP_TEST_LINKER = b'#ifdef TEST_LINKER\nint main() { return 0; }\n#endif'
+
+
+@pytest.fixture(scope="session")
+def cpp_sources(tmp_path_factory):
+    """Write the small C++ sources shared by the file handling tests once per session."""
+    d = tmp_path_factory.mktemp("cxx", numbered=False)
+    (d / 'test.cpp').write_bytes(_CPP_EMPTY_MAIN)
+    (d / 'main.cpp').write_bytes(_CPP_EMPTY_MAIN)
+    (d / 'main_with_linker.cpp').write_bytes(_CPP_TEST_LINKER)
+    return SimpleNamespace(dir=str(d), test_cpp=str(d / 'test.cpp'), main_cpp=str(d / 'main.cpp'),
+                           main_test_linker_cpp=str(d / 'main_with_linker.cpp'))
@@ -2,21 +2,30 @@
 # coding:utf8
 """Unit tests for py_cxx_builder module."""
 
+import json
 import os
+import shutil
+import struct
+import subprocess
 import sys
 import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
 import pytest
 
-from py_cxx_builder import CXXBuilder, ModiGCC, ModiMSVC
+import py_cxx_builder
+from py_cxx_builder import CXXBuilder, ModiGCC, ModiMSVC, _gcc_libdirs
+from py_cxx_builder.cli import Embedder
+
+_IS_WIN = (os.name == 'nt')
 
 
 @pytest.fixture
 def temp_project_dir():
     """Create a temporary directory with pyproject.toml for testing."""
     with tempfile.TemporaryDirectory() as tmpdir:
-        pyproject_path = os.path.join(tmpdir, 'pyproject.toml')
-        with open(pyproject_path, 'w') as f:
-            f.write('''[project]
+        Path(tmpdir, 'pyproject.toml').write_text('''[project]
 name = "test-project"
 version = "1.2.3"
 ''')
@@ -26,12 +35,36 @@ version = "1.2.3"
         os.chdir(old_cwd)
 
 
+@pytest.fixture
+def stateful_builder(temp_project_dir):
+    """A builder with the empty manifest and hash caches that build() would start from."""
+    builder = CXXBuilder()
+    builder._manifest, builder._depcache, builder._hashes = {}, {}, {}
+    return builder
+
+
+@pytest.fixture(scope="class")
+def ro_builder(tmp_path_factory):
+    """One builder shared by the tests that only inspect it."""
+    tmpdir = tmp_path_factory.mktemp("ro_project")
+    (tmpdir / 'pyproject.toml').write_text('''[project]
+name = "test-project"
+version = "1.2.3"
+''')
+    old_cwd = os.getcwd()
+    os.chdir(tmpdir)
+    try:
+        return CXXBuilder()
+    finally:
+        os.chdir(old_cwd)
+
+
 class TestCXXBuilder:
     """Tests for CXXBuilder class."""
 
-    def test_init(self, temp_project_dir):
+    def test_init(self, ro_builder):
         """Test CXXBuilder initialization."""
-        builder = CXXBuilder()
+        builder = ro_builder
         assert isinstance(builder.include_dirs, list)
         assert isinstance(builder.libdirs, list)
         assert isinstance(builder.macros, list)
@@ -43,57 +76,40 @@ class TestCXXBuilder:
         assert builder.name == "test-project"
         assert builder.version == "1.2.3"
 
-    def test_is_win_detection(self, temp_project_dir):
+    def test_is_win_detection(self, ro_builder):
         """Test platform detection."""
-        builder = CXXBuilder()
-        assert builder.is_win == (os.name == "nt")
+        assert ro_builder.is_win == _IS_WIN
 
-    def test_modi_selection(self, temp_project_dir):
+    def test_modi_selection(self, ro_builder):
         """Test correct modifier class is selected based on platform."""
-        builder = CXXBuilder()
-        if os.name == "nt":
-            assert isinstance(builder.modi, ModiMSVC)
+        if _IS_WIN:
+            assert isinstance(ro_builder.modi, ModiMSVC)
         else:
-            assert isinstance(builder.modi, ModiGCC)
-
-    def test_add_macro_with_value(self, temp_project_dir):
-        """Test adding macro with explicit value."""
-        builder = CXXBuilder()
-        initial_count = len(builder.macros)
-        builder.add_macro('TEST_MACRO', 42)
-        assert len(builder.macros) == initial_count + 1
-        assert ('TEST_MACRO', 42) in builder.macros
-
-    def test_add_macro_without_value(self, temp_project_dir):
-        """Test adding macro without value defaults to 1."""
+            assert isinstance(ro_builder.modi, ModiGCC)
+
+    @pytest.mark.parametrize("args,expected", [
+        (('TEST_MACRO', 42), ('TEST_MACRO', 42)),
+        (('ENABLE_FEATURE',), ('ENABLE_FEATURE', 1)),
+    ])
+    def test_add_macro(self, temp_project_dir, args, expected):
+        """Test adding macro with an explicit value or the default of 1."""
         builder = CXXBuilder()
         initial_count = len(builder.macros)
-        builder.add_macro('ENABLE_FEATURE')
+        builder.add_macro(*args)
         assert len(builder.macros) == initial_count + 1
-        assert ('ENABLE_FEATURE', 1) in builder.macros
+        assert expected in builder.macros
 
-    def test_add_files(self, temp_project_dir):
+    def test_add_files(self, temp_project_dir, cpp_sources):
         """Test adding source files."""
         builder = CXXBuilder()
-        # Create test file
-        test_file = os.path.join(temp_project_dir, 'test.cpp')
-        with open(test_file, 'w') as f:
-            f.write('int main() { return 0; }')
-
-        builder.add_files([test_file])
-        assert test_file in builder.files
+        builder.add_files([cpp_sources.test_cpp])
+        assert cpp_sources.test_cpp in builder.files
 
-    def test_add_files_with_directory(self, temp_project_dir):
+    def test_add_files_with_directory(self, temp_project_dir, cpp_sources):
         """Test adding source files with directory prefix."""
         builder = CXXBuilder()
-        # Create test file
-        test_file = 'test.cpp'
-        full_path = os.path.join(temp_project_dir, test_file)
-        with open(full_path, 'w') as f:
-            f.write('int main() { return 0; }')
-
-        builder.add_files([test_file], directory=temp_project_dir)
-        assert os.path.abspath(full_path) in builder.files
+        builder.add_files(['test.cpp'], directory=cpp_sources.dir)
+        assert os.path.abspath(cpp_sources.test_cpp) in builder.files
 
     def test_add_files_empty_string_ignored(self, temp_project_dir):
         """Test that empty strings in file list are ignored."""
@@ -102,19 +118,14 @@ class TestCXXBuilder:
         builder.add_files([''])
         assert len(builder.files) == initial_count
 
-    def test_remove_files(self, temp_project_dir):
+    def test_remove_files(self, temp_project_dir, cpp_sources):
         """Test removing source files."""
         builder = CXXBuilder()
-        # Create and add test file
-        test_file = os.path.join(temp_project_dir, 'test.cpp')
-        with open(test_file, 'w') as f:
-            f.write('int main() { return 0; }')
+        builder.add_files([cpp_sources.test_cpp])
+        assert cpp_sources.test_cpp in builder.files
 
-        builder.add_files([test_file])
-        assert test_file in builder.files
-
-        builder.remove_files([test_file])
-        assert test_file not in builder.files
+        builder.remove_files([cpp_sources.test_cpp])
+        assert cpp_sources.test_cpp not in builder.files
 
     def test_remove_nonexistent_file(self, temp_project_dir):
         """Test removing a file that was never added."""
@@ -122,33 +133,23 @@ class TestCXXBuilder:
         # Should not raise any exception
         builder.remove_files(['/nonexistent/file.cpp'])
 
-    def test_set_main_file(self, temp_project_dir):
+    def test_set_main_file(self, temp_project_dir, cpp_sources):
         """Test setting the main source file."""
         builder = CXXBuilder()
-        # Create test file
-        main_file = os.path.join(temp_project_dir, 'main.cpp')
-        with open(main_file, 'w') as f:
-            f.write('int main() { return 0; }')
-
-        builder.set_main_file(main_file)
-        assert builder.mainsrc == main_file
+        builder.set_main_file(cpp_sources.main_cpp)
+        assert builder.mainsrc == cpp_sources.main_cpp
         assert builder._need_test_link is False
 
-    def test_set_main_file_with_test_linker(self, temp_project_dir):
+    def test_set_main_file_with_test_linker(self, temp_project_dir, cpp_sources):
         """Test setting main file that contains TEST_LINKER."""
         builder = CXXBuilder()
-        main_file = os.path.join(temp_project_dir, 'main.cpp')
-        with open(main_file, 'w') as f:
-            f.write('#ifdef TEST_LINKER\nint main() { return 0; }\n#endif')
-
-        builder.set_main_file(main_file)
+        builder.set_main_file(cpp_sources.main_test_linker_cpp)
         assert builder._need_test_link is True
 
-    def test_sysver_format(self, temp_project_dir):
+    def test_sysver_format(self, ro_builder):
         """Test system version string format."""
-        builder = CXXBuilder()
         expected = f"{sys.version_info[0]}.{sys.version_info[1]}"
-        assert builder.sysver == expected
+        assert ro_builder.sysver == expected
 
     def test_hooker_called(self, temp_project_dir):
         """Test that platform hooker is called."""
@@ -158,7 +159,7 @@ class TestCXXBuilder:
             called.append(True)
             builder.add_macro('HOOKER_CALLED', 1)
 
-        if os.name == "nt":
+        if _IS_WIN:
             builder = CXXBuilder(nt_hooker=hooker)
         else:
             builder = CXXBuilder(posix_hooker=hooker)
@@ -166,49 +167,339 @@ class TestCXXBuilder:
         assert len(called) == 1
         assert ('HOOKER_CALLED', 1) in builder.macros
 
+    def test_batch_jobs_groups_sources(self, temp_project_dir):
+        """Test sources are chunked into batched compiles, embeds stay per-file."""
+        builder = CXXBuilder()
+        ext = builder.obj_ext
+        pending = [(f'/src/f{i}.cpp', f'build/objs/f{i}.cpp{ext}', None, ['cc', f'f{i}']) for i in range(4)]
+        pending.append(('/src/x.bin', f'build/objs/x.bin{ext}', 'embed', ['embed', 'x']))
+        jobs = builder._batch_jobs(pending, 2)
+        assert len(jobs) == 3
+        assert (['embed', 'x'], None, [], [pending[-1]]) in jobs
+        renames = [r for _, _, rs, _ in jobs for r in rs]
+        assert (os.path.join('build/objs', '.batch0', 'f0' + ext), f'build/objs/f0.cpp{ext}') in renames
+        assert len([r for r in renames if r[1].endswith(ext)]) == 4
+
+    def test_batch_jobs_distinct_outputs(self, temp_project_dir):
+        """Test batches never write the same intermediate object."""
+        builder = CXXBuilder()
+        ext = builder.obj_ext
+        pending = [(f'/src/{n}', f'build/o/{n}{ext}', None, ['cc', n])
+                   for n in ('a.cpp', 'b.cpp', 'a.c', 'b.c', 'sub/a.cpp')]
+        pending[-1] = ('/src/sub/a.cpp', f'build/o/a2.cpp{ext}', None, ['cc', 'a2'])
+        jobs = builder._batch_jobs(pending, 1)
+        produced = [r[0] for _, _, rs, _ in jobs for r in rs]
+        assert len(produced) == len(set(produced))
+        assert sorted(x for _, _, _, items in jobs for x in items) == sorted(pending)
+
+    def test_cc_wrapper_prefix(self, temp_project_dir):
+        """Test compiler cache wrapper is prepended when launching compiles but not embeds."""
+        builder = CXXBuilder()
+        builder.cc_wrapper = '/opt/ccache'
+        argv = builder.compile_argv('a.cpp', 'a.o')
+        assert '/opt/ccache' not in argv
+        assert builder._launch_argv(('a.cpp', 'a.o', None, argv)) == ['/opt/ccache', *argv]
+        embed = builder.compile_argv('a.bin', 'a.o', 'embed')
+        assert builder._launch_argv(('a.bin', 'a.o', 'embed', embed)) == embed
+        jobs = builder._batch_jobs([('a.cpp', 'a.o', None, argv)], 1)
+        assert jobs[0][0][0] == '/opt/ccache'
+
+    def test_need_compile_manifest(self, temp_project_dir, stateful_builder):
+        """Test rebuild decision follows source content and command line, not mtime."""
+        builder = stateful_builder
+        Path('blob.bin').write_bytes(b'abc')
+        Path('blob.o').write_bytes(b'')
+        assert builder._need_compile('blob.bin', 'blob.o', 'embed', 'cmd1')
+        builder._record([('blob.bin', 'blob.o', 'embed', ['cmd1'])])
+        os.utime('blob.bin', None)
+        assert not builder._need_compile('blob.bin', 'blob.o', 'embed', 'cmd1')
+        assert builder._need_compile('blob.bin', 'blob.o', 'embed', 'cmd2')
+        Path('blob.bin').write_bytes(b'abcd')
+        builder._hashes = {}
+        assert builder._need_compile('blob.bin', 'blob.o', 'embed', 'cmd1')
+
+    def test_scan_stats(self, temp_project_dir):
+        """Test sources are stat'ed by directory and missing ones are left out."""
+        os.makedirs('src')
+        for fn in ('a.cpp', 'src/b.cpp'):
+            Path(fn).write_text('x')
+        stats = CXXBuilder._scan_stats(['a.cpp', 'src/b.cpp', 'src/missing.cpp'], listing=True)
+        assert sorted(stats) == ['a.cpp', 'src/b.cpp']
+        assert stats['src/b.cpp'].st_size == 1
+        assert CXXBuilder._scan_stats(['a.cpp'], listing=False) == {}
+
+    def test_archive_argv_incremental(self, temp_project_dir, stateful_builder):
+        """Test an existing archive only gets the objects that changed."""
+        builder = stateful_builder
+        builder.modi = ModiGCC()
+        for fn in ('a.o', 'b.o', 'libx.a'):
+            Path(fn).write_bytes(b'x')
+        full = ['ar', 'rcs', 'libx.a', 'a.o', 'b.o']
+        argv, members = builder._archive_argv(full, 'libx.a', ['a.o', 'b.o'])
+        assert argv == full and not os.path.exists('libx.a')
+        Path('libx.a').write_bytes(b'')
+        builder._manifest['libx.a'] = {'objs': members}
+        assert builder._archive_argv(full, 'libx.a', ['a.o', 'b.o'])[0] is None
+        Path('b.o').write_bytes(b'yy')
+        argv = builder._archive_argv(full, 'libx.a', ['a.o', 'b.o'])[0]
+        if sys.platform != 'darwin':
+            assert argv == ['ar', 'rcs', 'libx.a', 'b.o']
+        assert builder._archive_argv(full, 'libx.a', ['b.o'])[0] == full
+        # clashing member names rebuild the archive, but only when something changed
+        os.makedirs('sub')
+        Path('sub/a.o').write_bytes(b'x')
+        objs = ['a.o', 'b.o', 'sub/a.o']
+        full = ['ar', 'rcs', 'libx.a', *objs]
+        Path('libx.a').write_bytes(b'')
+        builder._manifest['libx.a'] = {'objs': builder._archive_argv(full, 'libx.a', objs)[1]}
+        Path('libx.a').write_bytes(b'')
+        assert builder._archive_argv(full, 'libx.a', objs)[0] is None
+        Path('sub/a.o').write_bytes(b'yy')
+        assert builder._archive_argv(full, 'libx.a', objs)[0] == full
+
+    def test_compile_opts_cached_per_build(self, temp_project_dir, cpp_sources, monkeypatch):
+        """Test shared flags are fixed during build() and follow later edits afterwards."""
+        monkeypatch.setenv('LOCALAPPDATA' if _IS_WIN else 'XDG_CACHE_HOME', temp_project_dir)
+        builder = CXXBuilder()
+        builder.set_main_file(cpp_sources.main_cpp)
+        seen = []
+
+        def fake_build(nprocess):
+            seen.append(builder.compile_opts())
+            builder.include_dirs.append('during')
+            assert builder.compile_opts() is seen[0]
+            raise RuntimeError('stop')
+
+        monkeypatch.setattr(builder, '_build', fake_build)
+        with pytest.raises(RuntimeError):
+            builder.build(1)
+        builder.include_dirs.append('after')
+        builder.extra_compile_args.append('-Dextra')
+        argv = builder.compile_argv('a.cpp', 'a.o')
+        assert any(x.endswith('after') for x in argv) and '-Dextra' in argv
+
+    def test_build_fails_fast(self, temp_project_dir, monkeypatch):
+        """Test a failing compile cancels the queued ones and keeps what already finished."""
+        monkeypatch.setenv('LOCALAPPDATA' if _IS_WIN else 'XDG_CACHE_HOME', temp_project_dir)
+        names = ['ok0.cpp', 'bad.cpp'] + [f'ok{i}.cpp' for i in range(1, 7)]
+        for fn in names + ['main.cpp']:
+            Path(fn).write_text('int x;\n')
+        builder = CXXBuilder()
+        builder.cc_wrapper, builder.batch_compile = None, False
+        builder.add_files(names)
+        builder.set_main_file('main.cpp')
+        ran = []
+
+        def fake_compile(argv, **kwargs):
+            src = [x for x in argv if x in builder.files][0]
+            ran.append(os.path.basename(src))
+            if src.endswith('bad.cpp'):
+                time.sleep(0.05)
+                return 1
+            if not src.endswith('ok0.cpp'):
+                time.sleep(0.2)
+            obj = builder.files[src][0]
+            Path(obj).write_bytes(b'')
+            deps = json.dumps({'Data': {'Includes': []}}) if _IS_WIN else f'{obj}: {src}\n'
+            Path(builder.modi.deps_file(src, obj)).write_text(deps)
+            return 0
+
+        builder.bld_func = fake_compile
+        with pytest.raises(Exception, match='compile error'):
+            builder.build(2)
+        assert len(ran) < len(names)
+        manifest = json.loads(Path('build/.manifest.json').read_text())
+        assert builder.files[os.path.abspath('ok0.cpp')][0] in manifest
+        assert all(builder.files[os.path.abspath(x)][0] not in manifest for x in names if x not in ran)
+
+    def test_write_compile_commands_unchanged(self, temp_project_dir):
+        """Test compile_commands.json is only rewritten when its content changes."""
+        cmds = [{'directory': temp_project_dir, 'command': 'gcc -c a.cpp', 'file': 'a.cpp'}]
+        assert CXXBuilder._write_compile_commands(cmds)
+        assert json.loads(Path('compile_commands.json').read_text()) == cmds
+        assert not CXXBuilder._write_compile_commands(cmds)
+        assert CXXBuilder._write_compile_commands(cmds + cmds)
+
+    def test_record_reads_deps_file(self, temp_project_dir, stateful_builder):
+        """Test header dependencies come from the file the compile wrote."""
+        builder = stateful_builder
+        builder.modi = ModiGCC()
+        Path('a.cpp').write_text('#include "x.h"\n')
+        Path('x.h').write_text('')
+        builder._record([('a.cpp', 'a.o', None, ['cc'])])
+        assert 'a.o' not in builder._manifest
+        Path('a.o.d').write_text('a.o: a.cpp x.h\n')
+        builder._record([('a.cpp', 'a.o', None, ['cc'])])
+        assert list(builder._manifest['a.o']['deps']) == [os.path.abspath('x.h')]
+
+    def test_python_include_dirs_cached(self, temp_project_dir, monkeypatch):
+        """Test python include dirs are cached on disk."""
+        monkeypatch.setenv('LOCALAPPDATA' if _IS_WIN else 'XDG_CACHE_HOME', temp_project_dir)
+        first = CXXBuilder._python_include_dirs()
+        assert os.listdir(os.path.join(temp_project_dir, 'py_cxx_builder'))
+
+        def no_probe(*args, **kwargs):
+            raise AssertionError('include dirs probed again instead of read from the cache')
+
+        monkeypatch.setattr(py_cxx_builder, 'Distribution', no_probe)
+        assert CXXBuilder._python_include_dirs() == first
+
+    def test_pch_flags_only_for_cxx(self, temp_project_dir):
+        """Test precompiled header flags apply to C++ sources only."""
+        builder = CXXBuilder()
+        builder.set_pch('pch.h', directory=temp_project_dir)
+        assert builder.pch == os.path.abspath(os.path.join(temp_project_dir, 'pch.h'))
+        builder._pch_flags = ['-include-pch-marker']
+        assert '-include-pch-marker' in builder.compile_argv('a.cpp', 'a.o')
+        assert '-include-pch-marker' not in builder.compile_argv('a.c', 'a.o')
+
+    def test_pch_stub_matches_msvc_header_name(self, temp_project_dir, stateful_builder, monkeypatch):
+        """Test the MSVC pch stub includes the header spelled as /Yc names it."""
+        builder = stateful_builder
+        builder.modi, builder.obj_ext = ModiMSVC(), '.obj'
+        builder.set_pch('pch.h', directory=temp_project_dir)
+        calls = []
+        monkeypatch.setattr(subprocess, 'call', lambda argv: calls.append(argv) or 0)
+        builder._build_pch()
+        stub = [x for x in calls[0] if x.endswith('pch.cpp')][0]
+        assert f'/Yc{builder.pch}' in calls[0]
+        assert Path(stub).read_text() == f'#include "{builder.pch}"\n'
+        assert f'/FI{builder.pch}' in builder._pch_flags
+
     def test_load_toml_static_method(self, temp_project_dir):
         """Test load_toml static method."""
         data = CXXBuilder.load_toml('pyproject.toml')
         assert data['project']['name'] == 'test-project'
         assert data['project']['version'] == '1.2.3'
+        assert CXXBuilder.load_toml('pyproject.toml') is data
 
 
 class TestModiGCC:
     """Tests for ModiGCC class (only run on non-Windows)."""
 
-    @pytest.mark.skipif(os.name == 'nt', reason="GCC tests only run on Unix-like systems")
+    @pytest.mark.skipif(_IS_WIN, reason="GCC tests only run on Unix-like systems")
     def test_init(self):
         """Test ModiGCC initialization."""
         modi = ModiGCC()
         assert isinstance(modi.libdir1, list)
 
-    @pytest.mark.skipif(os.name == 'nt', reason="GCC tests only run on Unix-like systems")
+    @pytest.mark.skipif(_IS_WIN, reason="GCC tests only run on Unix-like systems")
+    def test_init_cached(self):
+        """Test the gcc triplet probe runs once per compiler."""
+        ModiGCC()
+        hits = _gcc_libdirs.cache_info().hits
+        assert ModiGCC().libdir1 == ModiGCC().libdir1
+        assert _gcc_libdirs.cache_info().hits == hits + 2
+
+    @pytest.mark.skipif(_IS_WIN, reason="GCC tests only run on Unix-like systems")
     def test_pref_static_nonexistent(self):
         """Test pref_static falls back to -l flag for nonexistent lib."""
         modi = ModiGCC()
         result = modi.pref_static('nonexistent_lib_xyz')
         assert result == '-lnonexistent_lib_xyz'
 
+    @pytest.mark.skipif(_IS_WIN, reason="GCC tests only run on Unix-like systems")
+    def test_parse_deps(self):
+        """Test parsing of make-style dependency output."""
+        modi = ModiGCC()
+        out = "a.o: /src/a.cpp /src/a.h \\\n /src/my\\ dir/b.h\n"
+        assert modi.parse_deps(out) == ['/src/a.cpp', '/src/a.h', '/src/my dir/b.h']
+
+    @pytest.mark.skipif(_IS_WIN or sys.platform == 'darwin' or not shutil.which('gcc'), reason="needs gcc on Linux")
+    def test_build_pch(self, temp_project_dir, stateful_builder):
+        """Test a real precompiled header build records the header it depends on."""
+        builder = stateful_builder
+        Path('pch.h').write_text('#include "inner.h"\n')
+        Path('inner.h').write_text('inline int pch_value() { return 1; }\n')
+        builder.set_pch('pch.h')
+        assert builder._build_pch() == []
+        gch = f'build/pch{builder.sysver}/pch.hxx.gch'
+        assert os.path.isfile(gch)
+        assert os.path.abspath('inner.h') in builder._manifest[gch]['deps']
+        assert builder._pch_key and '-Winvalid-pch' in builder._pch_flags
+
 
 class TestModiMSVC:
     """Tests for ModiMSVC class."""
 
+    def test_parse_deps(self):
+        """Test parsing of the /sourceDependencies json."""
+        text = json.dumps({'Version': '1.1', 'Data': {'Source': 'c:\\a.cpp', 'Includes': ['c:\\a.h', 'c:\\b.h']}})
+        assert ModiMSVC().parse_deps(text) == ['c:\\a.h', 'c:\\b.h']
+        assert ModiMSVC().deps_file('x.asm', 'x.obj') is None
+
+    @pytest.mark.skipif(not _IS_WIN, reason="MSVC tests only run on Windows")
     def test_init_method(self, temp_project_dir):
         """Test ModiMSVC init method."""
-        modi = ModiMSVC()
-        builder = CXXBuilder.__new__(CXXBuilder)
-        builder.include_dirs = []
-        builder.macros = []
-        builder.extra_compile_args = []
-        builder.extra_link_args = []
-        builder.libdirs = []
-        builder.sysver = "3.10"
-        builder.name = "test"
-
-        modi.init(builder)
-
+        builder = CXXBuilder()
+        assert isinstance(builder.modi, ModiMSVC)
         assert len(builder.macros) > 0
         assert len(builder.extra_compile_args) > 0
+        assert '/Z7' in builder.extra_compile_args
+        assert builder.obj_ext == '.obj'
+
+    def test_link_args_unique_libs(self):
+        """Test each library is linked once, in first-seen order."""
+        builder = SimpleNamespace(libs=['z', ('z', True), 'm'], libs2=['m', 'ws2_32'], extra_link_args=[])
+        libs, _ = ModiMSVC().link_args(builder, 'x.lib')
+        assert libs == ['z', 'm', 'ws2_32']
+
+    @pytest.mark.skipif(not _IS_WIN, reason="MSVC tests only run on Windows")
+    def test_init_source_date_epoch(self, temp_project_dir, monkeypatch):
+        """Test SOURCE_DATE_EPOCH turns on reproducible objects."""
+        monkeypatch.setenv('SOURCE_DATE_EPOCH', '1700000000')
+        # init sets VSLANG, let monkeypatch put it back afterwards
+        monkeypatch.delenv('VSLANG', raising=False)
+        builder = CXXBuilder()
+        assert '/Brepro' in builder.extra_compile_args
+        assert '/Brepro' in builder.extra_link_args
+
+    def test_compile_batch_argv(self):
+        """Test batched cl command uses /MP and an output directory."""
+        modi = ModiMSVC()
+        builder = SimpleNamespace(include_dirs=['inc'], macros=[('A', 1)], extra_compile_args=['/O2'], _pch_flags=[],
+                                  compile_opts=lambda: modi.compile_opts(builder))
+        argv, cwd = modi.compile_batch_argv(builder, ['a.cpp', 'b.cpp'], 'build\\objs', 4)
+        assert '/MP4' in argv and '/Iinc' in argv and '/DA=1' in argv
+        assert argv[-4:] == ['/Fobuild\\objs\\', 'a.cpp', 'b.cpp', '/O2']
+        assert cwd is None
+        assert modi.compile_batch_argv(builder, ['a.cpp', 'b.asm'], 'build', 4) is None
+
+
+class TestEmbedder:
+    """Tests for the embed command."""
+
+    def test_write_c_file(self, temp_project_dir):
+        """Test generated C array for an embedded blob, across chunk boundaries."""
+        Path('data-1.bin').write_bytes(b'\x00\x7f\xff')
+        embedder = Embedder('data-1.bin', 'data-1.o')
+        embedder.write_c_file()
+        code = Path(embedder.c_filename).read_bytes()
+        assert b'data_1_bin_content[] = {\n 0x00, 0x7f, 0xff, \n0\n};' in code
+        assert b'data_1_bin_size = sizeof(data_1_bin_content)-1;' in code
+        assert b''.join(embedder.c_code_chunks(chunk_size=2)) == code
+
+    def test_write_c_file_empty(self, temp_project_dir):
+        """Test an empty blob still gives a well-formed array."""
+        Path('empty.bin').write_bytes(b'')
+        embedder = Embedder('empty.bin', 'empty.o')
+        embedder.write_c_file()
+        assert b'empty_bin_content[] = {\n \n0\n};' in Path(embedder.c_filename).read_bytes()
+
+    @pytest.mark.skipif(not Embedder.can_link_binary(), reason="needs GNU ld and objcopy")
+    def test_link_binary(self, temp_project_dir):
+        """Test blobs are wrapped into an object without a C source."""
+        Path('blob.bin').write_bytes(b'abc')
+        Embedder('blob.bin', 'blob.o').run()
+        assert not os.path.exists('blob.c')
+        assert not os.path.exists('blob.payload')
+        syms = {}
+        for line in subprocess.run(['nm', 'blob.o'], stdout=subprocess.PIPE, text=True, check=True).stdout.splitlines():
+            addr, typ, name = line.split()
+            syms[name] = (int(addr, 16), typ)
+        assert syms == {'blob_bin_content': (0, 'R'), 'blob_bin_size': (4, 'R')}
+        subprocess.run(['objcopy', '-O', 'binary', '--only-section=.rodata', 'blob.o', 'rodata.bin'], check=True)
+        assert Path('rodata.bin').read_bytes() == b'abc\0' + struct.pack('=I', 3)
 
 
 class TestImport: